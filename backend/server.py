@@ -1,26 +1,52 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, UpdateOne, WriteConcern
+from pymongo.errors import PyMongoError
+from cachetools import TTLCache
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone
+import asyncio
+import hashlib
+import itertools
+from datetime import datetime, timedelta, timezone
+from functools import partial
 import time
 
+# Bound once so hot paths skip the attribute lookups
+_utcnow = datetime.now
+_UTC = timezone.utc
+
+def _minute_bucket(ts: datetime) -> datetime:
+    return ts.replace(second=0, microsecond=0)
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+MONGO_MIN_POOL_SIZE = 20
+client = AsyncMongoClient(
+    mongo_url,
+    tz_aware=True,
+    uuidRepresentation='standard',
+    maxPoolSize=200,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=60000,
+    socketTimeoutMS=10000,
+    serverSelectionTimeoutMS=3000,
+    waitQueueTimeoutMS=2000,
+    retryWrites=True,
+)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -29,26 +55,17 @@ api_router = APIRouter(prefix="/api")
 class Session(BaseModel):
     model_config = ConfigDict(extra="ignore")
     
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    start_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    id: uuid.UUID = Field(default_factory=uuid.uuid4)
+    start_time: datetime = Field(default_factory=partial(_utcnow, _UTC))
     end_time: Optional[datetime] = None
     is_active: bool = True
 
 class SessionCreate(BaseModel):
     pass
 
-class TrackingEvent(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    session_id: str
-    event_type: str  # scroll, click, mousemove, idle, visibility, tab_count
-    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    data: dict = {}
-
 class TrackingEventCreate(BaseModel):
-    session_id: str
-    event_type: str
+    session_id: uuid.UUID
+    event_type: str  # scroll, click, mousemove, idle, visibility, tab_count
     data: dict = {}
 
 class DriftAnalysis(BaseModel):
@@ -59,7 +76,7 @@ class DriftAnalysis(BaseModel):
     recommendation: str
 
 class SessionStats(BaseModel):
-    session_id: str
+    session_id: uuid.UUID
     active_time: float
     scroll_count: int
     click_count: int
@@ -73,15 +90,44 @@ class SessionStats(BaseModel):
 class DriftDetector:
     """Rule-based drift detection simulating LSTM behavior"""
     
+    # Drift scores don't change meaningfully at sub-second granularity, so
+    # polling clients can share a short-lived result per session
+    _cache = TTLCache(maxsize=10_000, ttl=3)
+    # Pending analyses, so concurrent callers for a session share one query
+    _inflight: dict = {}
+    # Bumped by invalidate, so a load that straddles a flush doesn't cache its result
+    _generations = TTLCache(maxsize=10_000, ttl=60)
+    _next_generation = itertools.count(1)
+    
+    # Scoring looks at the current and previous minute of activity only
+    WINDOW_MINUTES = 2
+    COUNTER_FIELDS = ('scroll', 'click', 'mousemove', 'idle', 'tab_switches')
+    
+    @classmethod
+    def window_start(cls) -> datetime:
+        return _minute_bucket(_utcnow(_UTC)) - timedelta(minutes=cls.WINDOW_MINUTES - 1)
+    
+    @classmethod
+    def recent_activity_pipeline(cls, session_id: uuid.UUID) -> List[dict]:
+        """Stages selecting a session's session_activity buckets inside the window"""
+        return [
+            {"$match": {"session_id": session_id, "minute": {"$gte": cls.window_start()}}},
+            {"$project": {"_id": 0, **{field: 1 for field in cls.COUNTER_FIELDS}}},
+        ]
+    
     @staticmethod
-    async def analyze_session(session_id: str, db_instance) -> DriftAnalysis:
-        # Get recent events (last 60 seconds)
-        cutoff_time = datetime.now(timezone.utc)
-        events = await db_instance.tracking_events.find({
-            "session_id": session_id,
-        }).sort("timestamp", -1).limit(100).to_list(100)
-        
-        if not events:
+    async def analyze_session(session_id: uuid.UUID, db_instance) -> DriftAnalysis:
+        # Per-minute activity buckets, maintained by EventBuffer on every flush
+        cursor = await db_instance.session_activity.aggregate(
+            DriftDetector.recent_activity_pipeline(session_id)
+        )
+        buckets = await cursor.to_list(None)
+        return DriftDetector.analyze_buckets(buckets)
+    
+    @staticmethod
+    def analyze_buckets(buckets: List[dict]) -> DriftAnalysis:
+        """Score the recent session_activity buckets of a session"""
+        if not buckets:
             return DriftAnalysis(
                 is_drifting=False,
                 confidence=0.0,
@@ -90,12 +136,21 @@ class DriftDetector:
                 recommendation="Keep going! Start tracking your activity."
             )
         
+        counters = {}
+        for bucket in buckets:
+            for field in DriftDetector.COUNTER_FIELDS:
+                counters[field] = counters.get(field, 0) + bucket.get(field, 0)
+        return DriftDetector.score(counters)
+    
+    @staticmethod
+    def score(counters: dict) -> DriftAnalysis:
+        """Score event counts from the recent activity window"""
         # Calculate metrics
-        scroll_count = sum(1 for e in events if e.get('event_type') == 'scroll')
-        click_count = sum(1 for e in events if e.get('event_type') == 'click')
-        mouse_movements = sum(1 for e in events if e.get('event_type') == 'mousemove')
-        idle_events = sum(1 for e in events if e.get('event_type') == 'idle')
-        tab_switches = sum(1 for e in events if e.get('event_type') == 'tab_count' and e.get('data', {}).get('count', 1) > 3)
+        scroll_count = counters.get('scroll', 0)
+        click_count = counters.get('click', 0)
+        mouse_movements = counters.get('mousemove', 0)
+        idle_events = counters.get('idle', 0)
+        tab_switches = counters.get('tab_switches', 0)
         
         # Drift scoring (0-100)
         drift_score = 0.0
@@ -150,6 +205,166 @@ class DriftDetector:
             factors=factors,
             recommendation=recommendation
         )
+    
+    @classmethod
+    async def cached_analysis(cls, session_id: uuid.UUID, db_instance) -> DriftAnalysis:
+        """Return analyze_session's result, reusing it for a few seconds per session"""
+        analysis = cls._cache.get(session_id)
+        if analysis is not None:
+            return analysis
+        
+        future = cls._inflight.get(session_id)
+        if future is None:
+            future = asyncio.ensure_future(cls._load_analysis(session_id, db_instance))
+            cls._inflight[session_id] = future
+            future.add_done_callback(lambda done: cls._forget_inflight(session_id, done))
+        
+        # Shield so a cancelled caller doesn't cancel the query for the others
+        return await asyncio.shield(future)
+    
+    @classmethod
+    def invalidate(cls, session_ids):
+        """Drop cached analyses for sessions whose counters just changed"""
+        for session_id in session_ids:
+            cls._cache.pop(session_id, None)
+            # Later callers start a fresh query instead of joining a pre-flush one
+            cls._inflight.pop(session_id, None)
+            cls._generations[session_id] = next(cls._next_generation)
+    
+    @classmethod
+    def _forget_inflight(cls, session_id: uuid.UUID, future: asyncio.Future):
+        # Only clear our own entry; invalidate may already have replaced it
+        if cls._inflight.get(session_id) is future:
+            del cls._inflight[session_id]
+    
+    @classmethod
+    async def _load_analysis(cls, session_id: uuid.UUID, db_instance) -> DriftAnalysis:
+        generation = cls._generations.get(session_id)
+        analysis = await cls.analyze_session(session_id, db_instance)
+        if cls._generations.get(session_id) == generation:
+            cls._cache[session_id] = analysis
+        return analysis
+
+# Buffered event writes
+class EventBuffer:
+    """Queues tracking events and writes them to Mongo in batches"""
+    
+    # Event types tallied into session_counters as-is
+    COUNTED_EVENTS = {'scroll', 'click', 'mousemove', 'idle'}
+    
+    def __init__(self, db_instance, flush_interval: float = 0.1, batch_size: int = 500):
+        self.db = db_instance
+        # Raw events are telemetry, so their inserts go unacknowledged; the
+        # session_counters updates keep the default write concern
+        self.events = db_instance.get_collection("tracking_events", write_concern=WriteConcern(w=0))
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._flush_now = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+    
+    def put(self, doc: dict):
+        self.queue.put_nowait(doc)
+        if self.queue.qsize() >= self.batch_size:
+            self._flush_now.set()
+    
+    def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background writer and flush whatever is still queued"""
+        self._stopping = True
+        self._flush_now.set()
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+    
+    async def flush(self):
+        while not self.queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                # Unordered so one bad document doesn't abort the rest of the batch
+                await self.events.insert_many(batch, ordered=False)
+            except Exception:
+                logger.exception("Failed to write %d tracking events", len(batch))
+            try:
+                await self.db.session_counters.bulk_write(self._counter_updates(batch), ordered=False)
+            except Exception:
+                logger.exception("Failed to update session counters for %d events", len(batch))
+            # Separate from the lifetime counters: drift scoring depends on this write alone
+            activity_updates = self._activity_updates(batch)
+            if activity_updates:
+                try:
+                    await self.db.session_activity.bulk_write(activity_updates, ordered=False)
+                except Exception:
+                    logger.exception("Failed to update session activity for %d events", len(batch))
+            # The TTL cache should only ever serve analyses of unchanged counters
+            DriftDetector.invalidate({doc['session_id'] for doc in batch})
+    
+    @classmethod
+    def _counter_field(cls, doc: dict) -> Optional[str]:
+        """Counter an event increments, if any"""
+        event_type = doc['event_type']
+        if event_type in cls.COUNTED_EVENTS:
+            return event_type
+        if event_type == 'tab_count':
+            count = doc['data'].get('count', 1)
+            if isinstance(count, (int, float)) and count > 3:
+                return 'tab_switches'
+        return None
+    
+    @classmethod
+    def _counter_updates(cls, batch: List[dict]) -> List[UpdateOne]:
+        """Fold a batch of events into one lifetime $inc upsert per session"""
+        increments = {}
+        last_activity = {}
+        for doc in batch:
+            session_id = doc['session_id']
+            inc = increments.setdefault(session_id, {})
+            field = cls._counter_field(doc)
+            if field:
+                inc[field] = inc.get(field, 0) + 1
+            last_activity[session_id] = max(last_activity.get(session_id, doc['timestamp']), doc['timestamp'])
+        
+        updates = []
+        for session_id, inc in increments.items():
+            update = {"$max": {"last_activity": last_activity[session_id]}}
+            if inc:
+                update["$inc"] = inc
+            updates.append(UpdateOne({"_id": session_id}, update, upsert=True))
+        return updates
+    
+    @classmethod
+    def _activity_updates(cls, batch: List[dict]) -> List[UpdateOne]:
+        """Fold a batch of events into one $inc upsert per session and minute"""
+        increments = {}
+        for doc in batch:
+            field = cls._counter_field(doc)
+            if field:
+                key = (doc['session_id'], _minute_bucket(doc['timestamp']))
+                inc = increments.setdefault(key, {})
+                inc[field] = inc.get(field, 0) + 1
+        
+        return [
+            UpdateOne({"session_id": session_id, "minute": minute}, {"$inc": inc}, upsert=True)
+            for (session_id, minute), inc in increments.items()
+        ]
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+event_buffer = EventBuffer(db)
 
 # API Routes
 @api_router.get("/")
@@ -161,9 +376,6 @@ async def start_session(input: SessionCreate):
     """Start a new tracking session"""
     session = Session()
     doc = session.model_dump()
-    doc['start_time'] = doc['start_time'].isoformat()
-    if doc['end_time']:
-        doc['end_time'] = doc['end_time'].isoformat()
     
     await db.sessions.insert_one(doc)
     return session
@@ -171,65 +383,86 @@ async def start_session(input: SessionCreate):
 @api_router.post("/tracking/event")
 async def log_tracking_event(input: TrackingEventCreate):
     """Log a tracking event"""
-    event = TrackingEvent(**input.model_dump())
-    doc = event.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
+    # Only queued here; EventBuffer writes it within ~100 ms
+    doc = {
+        "id": uuid.uuid4(),
+        "session_id": input.session_id,
+        "event_type": input.event_type,
+        "timestamp": _utcnow(_UTC),
+        "data": input.data,
+    }
     
-    await db.tracking_events.insert_one(doc)
-    return {"status": "logged", "event_id": event.id}
+    event_buffer.put(doc)
+    return {"status": "queued", "event_id": doc["id"]}
 
 @api_router.get("/tracking/analysis/{session_id}", response_model=DriftAnalysis)
-async def get_drift_analysis(session_id: str):
+async def get_drift_analysis(session_id: uuid.UUID, request: Request, response: Response):
     """Get real-time drift analysis for a session"""
-    analysis = await DriftDetector.analyze_session(session_id, db)
+    # Reflects events once EventBuffer has flushed them, i.e. up to ~100 ms after
+    # their POST returned; a read sent immediately after a write may not see it
+    analysis = await DriftDetector.cached_analysis(session_id, db)
+    
+    # Polling clients and proxies may reuse an analysis for a couple of seconds;
+    # the ETag covers the body itself, so a 304 always means nothing changed
+    digest = hashlib.blake2b(analysis.model_dump_json().encode(), digest_size=8).hexdigest()
+    etag = f'W/"{digest}"'
+    headers = {"Cache-Control": "public, max-age=2, stale-while-revalidate=3", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
     return analysis
 
 @api_router.get("/session/{session_id}/stats", response_model=SessionStats)
-async def get_session_stats(session_id: str):
+async def get_session_stats(session_id: uuid.UUID):
     """Get statistics for a session"""
-    # Get all events for the session
-    events = await db.tracking_events.find({"session_id": session_id}).to_list(1000)
+    # Get the session with its lifetime counters and recent activity in one round trip
+    cursor = await db.sessions.aggregate([
+        {"$match": {"id": session_id}},
+        {"$lookup": {
+            "from": "session_counters",
+            "localField": "id",
+            "foreignField": "_id",
+            "as": "counters",
+        }},
+        {"$lookup": {
+            "from": "session_activity",
+            "pipeline": DriftDetector.recent_activity_pipeline(session_id),
+            "as": "recent",
+        }},
+        {"$project": {"_id": 0, "start_time": 1, "counters": 1, "recent": 1}},
+    ])
+    docs = await cursor.to_list(1)
     
-    if not events:
+    if not docs or not docs[0]['counters']:
         raise HTTPException(status_code=404, detail="Session not found")
+    session_doc = docs[0]
+    counters = session_doc['counters'][0]
     
-    # Calculate stats
-    scroll_count = sum(1 for e in events if e.get('event_type') == 'scroll')
-    click_count = sum(1 for e in events if e.get('event_type') == 'click')
-    mouse_movements = sum(1 for e in events if e.get('event_type') == 'mousemove')
-    idle_events = sum(1 for e in events if e.get('event_type') == 'idle')
+    active_time = (_utcnow(_UTC) - session_doc['start_time']).total_seconds()
     
-    # Get session
-    session_doc = await db.sessions.find_one({"id": session_id}, {"_id": 0})
-    if not session_doc:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    start_time = datetime.fromisoformat(session_doc['start_time'])
-    active_time = (datetime.now(timezone.utc) - start_time).total_seconds()
-    
-    # Get drift analysis
-    analysis = await DriftDetector.analyze_session(session_id, db)
+    # Score the recent buckets already in hand rather than querying them again
+    analysis = DriftDetector.analyze_buckets(session_doc['recent'])
     
     return SessionStats(
         session_id=session_id,
         active_time=active_time,
-        scroll_count=scroll_count,
-        click_count=click_count,
-        mouse_movements=mouse_movements,
-        idle_time=idle_events * 5.0,  # Assuming 5s idle check
-        tab_switches=0,
+        scroll_count=counters.get('scroll', 0),
+        click_count=counters.get('click', 0),
+        mouse_movements=counters.get('mousemove', 0),
+        idle_time=counters.get('idle', 0) * 5.0,  # Assuming 5s idle check
+        tab_switches=counters.get('tab_switches', 0),
         drift_detected=analysis.is_drifting,
         drift_score=analysis.drift_score
     )
 
 @api_router.delete("/session/{session_id}")
-async def end_session(session_id: str):
+async def end_session(session_id: uuid.UUID):
     """End a tracking session"""
     result = await db.sessions.update_one(
         {"id": session_id},
         {"$set": {
             "is_active": False,
-            "end_time": datetime.now(timezone.utc).isoformat()
+            "end_time": _utcnow(_UTC)
         }}
     )
     
@@ -256,6 +489,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def warm_connection_pool():
+    # Concurrent pings each check out a connection, so the pool is filled up front.
+    # minPoolSize refills it in the background anyway, so a slow database must not
+    # stop the app from booting
+    try:
+        await asyncio.gather(*(client.admin.command('ping') for _ in range(MONGO_MIN_POOL_SIZE)))
+    except PyMongoError as e:
+        logger.warning("Could not warm the MongoDB connection pool: %s", e)
+
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        # Raw events are only kept for an hour; session_counters holds the running totals
+        await db.tracking_events.create_index("timestamp", expireAfterSeconds=3600)
+        await db.sessions.create_index("id", unique=True)
+        # Activity buckets only matter inside the scoring window; keep an hour of them
+        await db.session_activity.create_index([("session_id", 1), ("minute", 1)], unique=True)
+        await db.session_activity.create_index("minute", expireAfterSeconds=3600)
+    except PyMongoError as e:
+        logger.warning("Could not create MongoDB indexes: %s", e)
+
+@app.on_event("startup")
+async def start_event_buffer():
+    event_buffer.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await event_buffer.stop()
+    await client.close()
\ No newline at end of file
@@ -0,0 +1,128 @@
+import asyncio
+import uuid
+
+from server import DriftDetector
+
+
+class _Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class _ActivityCollection:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = 0
+
+    async def aggregate(self, pipeline):
+        self.queries += 1
+        docs = list(self.docs)
+        # Stay pending long enough for every caller to pile up
+        await asyncio.sleep(0.01)
+        return _Cursor(docs)
+
+
+class _Db:
+    def __init__(self, docs):
+        self.session_activity = _ActivityCollection(docs)
+
+
+def test_score_quiet_session_only_flags_low_activity():
+    analysis = DriftDetector.score({"scroll": 2, "click": 1})
+
+    assert analysis.drift_score == 10
+    assert analysis.factors == {"low_activity": True}
+    assert not analysis.is_drifting
+
+
+def test_score_idle_and_scrolling_is_drifting():
+    analysis = DriftDetector.score({"scroll": 25, "click": 1, "idle": 5})
+
+    assert analysis.drift_score == 55
+    assert analysis.is_drifting
+    assert analysis.confidence == 0.55
+    assert analysis.recommendation == "Take a short break or switch tasks to re-engage."
+
+
+def test_analyze_buckets_sums_the_window():
+    analysis = DriftDetector.analyze_buckets([
+        {"scroll": 15, "idle": 2},
+        {"scroll": 10, "click": 1, "idle": 2},
+    ])
+
+    assert analysis.factors == {"excessive_scrolling": True, "idle_behavior": True}
+
+
+def test_analyze_buckets_without_activity():
+    analysis = DriftDetector.analyze_buckets([])
+
+    assert analysis.drift_score == 0.0
+    assert analysis.factors == {}
+
+
+def test_concurrent_cached_analysis_runs_one_query():
+    session_id = uuid.uuid4()
+    db = _Db([{"idle": 5}])
+    DriftDetector._cache.pop(session_id, None)
+
+    async def run():
+        return await asyncio.gather(*(
+            DriftDetector.cached_analysis(session_id, db) for _ in range(20)
+        ))
+
+    results = asyncio.run(run())
+
+    assert db.session_activity.queries == 1
+    assert all(r == results[0] for r in results)
+    assert results[0].factors["idle_behavior"]
+    assert session_id not in DriftDetector._inflight
+
+
+def test_caller_after_invalidation_does_not_join_stale_query():
+    session_id = uuid.uuid4()
+    db = _Db([])
+    DriftDetector._cache.pop(session_id, None)
+
+    async def run():
+        early = [
+            asyncio.ensure_future(DriftDetector.cached_analysis(session_id, db))
+            for _ in range(5)
+        ]
+        await asyncio.sleep(0.001)
+        db.session_activity.docs = [{"idle": 5}]
+        DriftDetector.invalidate({session_id})
+        late = await DriftDetector.cached_analysis(session_id, db)
+        return await asyncio.gather(*early), late
+
+    early, late = asyncio.run(run())
+
+    # The early callers still share one pre-flush query; the late one gets a fresh one
+    assert db.session_activity.queries == 2
+    assert all(r.factors == {} for r in early)
+    assert late.factors["idle_behavior"]
+    assert session_id not in DriftDetector._inflight
+
+
+def test_flush_during_load_does_not_cache_stale_analysis():
+    session_id = uuid.uuid4()
+    db = _Db([])
+    DriftDetector._cache.pop(session_id, None)
+
+    async def run():
+        load = asyncio.ensure_future(DriftDetector.cached_analysis(session_id, db))
+        # Let the load read the pre-flush activity, then flush underneath it
+        await asyncio.sleep(0.001)
+        db.session_activity.docs = [{"idle": 5}]
+        DriftDetector.invalidate({session_id})
+        stale = await load
+        return stale, await DriftDetector.cached_analysis(session_id, db)
+
+    stale, fresh = asyncio.run(run())
+
+    assert stale.factors == {}
+    assert fresh.factors["idle_behavior"]
+    assert db.session_activity.queries == 2
+    assert DriftDetector._cache[session_id] == fresh
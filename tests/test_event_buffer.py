@@ -0,0 +1,126 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+from server import DriftDetector, DriftAnalysis, EventBuffer
+
+
+def _event(session_id, event_type, ts, data=None):
+    return {
+        "id": uuid.uuid4(),
+        "session_id": session_id,
+        "event_type": event_type,
+        "timestamp": ts,
+        "data": data or {},
+    }
+
+
+class _Collection:
+    def __init__(self):
+        self.calls = []
+
+    async def insert_many(self, docs, ordered=True):
+        self.calls.append(list(docs))
+
+    async def bulk_write(self, requests, ordered=True):
+        self.calls.append(list(requests))
+
+
+class _FailingCollection(_Collection):
+    async def bulk_write(self, requests, ordered=True):
+        raise RuntimeError("write failed")
+
+
+class _Db:
+    def __init__(self):
+        self.tracking_events = _Collection()
+        self.session_counters = _Collection()
+        self.session_activity = _Collection()
+
+    def get_collection(self, name, write_concern=None):
+        return getattr(self, name)
+
+
+def test_counter_updates_fold_one_upsert_per_session():
+    a, b = uuid.uuid4(), uuid.uuid4()
+    t1 = datetime(2026, 1, 1, 12, 0, 5, tzinfo=timezone.utc)
+    t2 = datetime(2026, 1, 1, 12, 0, 9, tzinfo=timezone.utc)
+    batch = [
+        _event(a, "scroll", t1),
+        _event(a, "scroll", t2),
+        _event(a, "click", t1),
+        _event(a, "tab_count", t1, {"count": 5}),
+        _event(a, "tab_count", t1, {"count": 2}),
+        _event(b, "visibility", t1, {"hidden": True}),
+    ]
+
+    assert EventBuffer._counter_updates(batch) == [
+        UpdateOne(
+            {"_id": a},
+            {"$max": {"last_activity": t2}, "$inc": {"scroll": 2, "click": 1, "tab_switches": 1}},
+            upsert=True,
+        ),
+        # Uncounted events still record activity but send no empty $inc
+        UpdateOne({"_id": b}, {"$max": {"last_activity": t1}}, upsert=True),
+    ]
+
+
+def test_activity_updates_bucket_by_minute():
+    session_id = uuid.uuid4()
+    batch = [
+        _event(session_id, "idle", datetime(2026, 1, 1, 12, 0, 5, tzinfo=timezone.utc)),
+        _event(session_id, "idle", datetime(2026, 1, 1, 12, 0, 59, tzinfo=timezone.utc)),
+        _event(session_id, "idle", datetime(2026, 1, 1, 12, 1, 0, tzinfo=timezone.utc)),
+        _event(session_id, "visibility", datetime(2026, 1, 1, 12, 1, 0, tzinfo=timezone.utc)),
+    ]
+
+    assert EventBuffer._activity_updates(batch) == [
+        UpdateOne(
+            {"session_id": session_id, "minute": datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)},
+            {"$inc": {"idle": 2}},
+            upsert=True,
+        ),
+        UpdateOne(
+            {"session_id": session_id, "minute": datetime(2026, 1, 1, 12, 1, tzinfo=timezone.utc)},
+            {"$inc": {"idle": 1}},
+            upsert=True,
+        ),
+    ]
+
+
+def test_flush_writes_batch_and_invalidates_cached_analysis():
+    session_id = uuid.uuid4()
+    db = _Db()
+    buffer = EventBuffer(db)
+    DriftDetector._cache[session_id] = DriftAnalysis(
+        is_drifting=False, confidence=0.0, drift_score=0.0, factors={}, recommendation=""
+    )
+
+    async def run():
+        for _ in range(3):
+            buffer.put(_event(session_id, "click", datetime.now(timezone.utc)))
+        await buffer.flush()
+
+    asyncio.run(run())
+
+    assert [len(docs) for docs in db.tracking_events.calls] == [3]
+    assert len(db.session_counters.calls) == 1
+    assert len(db.session_activity.calls) == 1
+    assert session_id not in DriftDetector._cache
+
+
+def test_activity_is_written_when_counter_update_fails():
+    session_id = uuid.uuid4()
+    db = _Db()
+    db.session_counters = _FailingCollection()
+    buffer = EventBuffer(db)
+
+    async def run():
+        buffer.put(_event(session_id, "idle", datetime.now(timezone.utc)))
+        await buffer.flush()
+
+    asyncio.run(run())
+
+    assert len(db.session_activity.calls) == 1